@@ -0,0 +1,291 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from multiprocessing import get_context
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from s3access.dedup import Deduplicator, KeyIndex
+from s3access.normalize import iter_items, transform_item
+from s3access.partition import parse_partition_cols
+from s3access.schema import create_schema
+from s3access.serializer import match_log
+from s3access.spill import (
+    dedup_spilled_dataset,
+    save_spilled_keys,
+    spill_dataset,
+    write_spilled_dataset,
+)
+
+# https://docs.aws.amazon.com/AmazonS3/latest/userguide/LogExample.html
+LINE = (
+    "79a59df900b949e55d96a1e698fbacedfd6e09d98eacf8f8d5218e7cd47ef2be DOC-EXAMPLE-BUCKET1 "
+    "[06/Feb/2019:00:{minute:02d}:{second:02d} +0000] {remoteip} "
+    "arn:aws:sts::123456789012:assumed-role/example/session 3E57427F3EXAMPLE{row} {operation} - "
+    '"GET /DOC-EXAMPLE-BUCKET1?versioning HTTP/1.1" 200 - 113 - 7 - "-" "S3Console/0.4" - '
+    "s9lzHYrFp76ZVxRcpX9+5cjAnEH2ROuNkd2BHfIa6UkFVdtjf5mKR3/eTPFvsiP/XV/VLi31234= "
+    "SigV4 ECDHE-RSA-AES128-GCM-SHA256 AuthHeader DOC-EXAMPLE-BUCKET1.s3.us-west-1.amazonaws.com "
+    "TLSV1.2{extra}"
+)
+
+
+# Skewed like real traffic, most requests are for a few operations
+OPERATIONS = (
+    ["REST.GET.OBJECT"] * 14
+    + ["REST.HEAD.OBJECT"] * 3
+    + ["REST.PUT.OBJECT", "REST.GET.BUCKET", "REST.GET.VERSIONING"]
+)
+
+
+def create_line(row, remoteip="192.0.2.3", extra="", operation="REST.GET.VERSIONING"):
+    return LINE.format(
+        minute=(row // 60) % 60,
+        second=row % 60,
+        remoteip=remoteip,
+        row=row,
+        operation=operation,
+        extra=extra,
+    )
+
+
+def create_lines(rows, mixed):
+    """
+    Return synthetic log lines. When mixed, one in ten lines is an IPv6
+    client, one in ten has the newer trailing fields, and one in a hundred is
+    malformed.
+    """
+    lines = []
+    for row in range(rows):
+        if mixed and row % 100 == 99:
+            lines.append(create_line(row)[0:80])
+        elif mixed and row % 10 == 1:
+            lines.append(
+                create_line(row, remoteip="2001:db8::{:x}".format(row % 65536))
+            )
+        elif mixed and row % 10 == 2:
+            lines.append(create_line(row, extra=" - Yes"))
+        else:
+            lines.append(create_line(row))
+    return lines
+
+
+def benchmark_transform(items, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            try:
+                transform_item(item)
+            except (ValueError, OSError):
+                pass
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(items) / best
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident memory of this process and of its largest child.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+def create_hour(src, files, file_rows):
+    """
+    Write synthetic log files for one hour and return their paths.
+    """
+    paths = []
+    for i in range(files):
+        path = os.path.join(src, "2019-02-06-00-00-00-{:08d}".format(i))
+        with open(path, "w") as f:
+            for row in range(i * file_rows, (i + 1) * file_rows):
+                operation = OPERATIONS[row % len(OPERATIONS)]
+                f.write(create_line(row, operation=operation) + "\n")
+        paths.append(path)
+    return paths
+
+
+def items_mb(path):
+    """
+    Return the memory used by the transformed items of one file, which is
+    what aggregate_range holds in memory for every file of the hour.
+    """
+    stats = {"filtered": 0, "quarantined": []}
+    tracemalloc.start()
+    items = list(iter_items(path, None, stats))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del items
+    return size / 1024 / 1024
+
+
+def run_spill():
+    """
+    Spill and write the files listed in FILES, then print the peak memory.
+    Run in its own process so the peak memory is for this run only.
+    """
+    files = os.getenv("FILES").split(",")
+    dst = os.getenv("DST")
+    cpu_count = int(os.getenv("CPU_COUNT", "2"))
+    dedup = os.getenv("DEDUP", "false").lower() == "true"
+
+    logging_queue = get_context("spawn").Manager().Queue(-1)
+    partition_cols = parse_partition_cols(None)
+    schema = create_schema()
+
+    deduplicator = None
+    if dedup:
+        deduplicator = Deduplicator(index=KeyIndex(os.path.join(dst, "_dedup") + "/"))
+
+    spill_root = os.path.join(dst, "_spill")
+    spilled, quarantined = spill_dataset(
+        files,
+        None,
+        spill_root,
+        schema,
+        partition_cols,
+        cpu_count=cpu_count,
+        logging_queue=logging_queue,
+        dedup=dedup,
+    )
+    if dedup:
+        spilled, pending, partitions = dedup_spilled_dataset(
+            spilled,
+            spill_root,
+            schema,
+            partition_cols,
+            deduplicator,
+            cpu_count=cpu_count,
+            logging_queue=logging_queue,
+        )
+    layout = write_spilled_dataset(
+        spilled,
+        dst,
+        partition_cols,
+        schema,
+        compression="SNAPPY",
+        cpu_count=cpu_count,
+        makedirs=True,
+        logging_queue=logging_queue,
+    )
+    if dedup:
+        save_spilled_keys(deduplicator.index, pending, partitions, [])
+    shutil.rmtree(spill_root)
+
+    own, children = peak_rss_mb()
+    print(
+        "{} {} {:.0f} {:.0f}".format(
+            sum([f["rows"] for f in layout]), len(layout), own, children
+        )
+    )
+
+
+def benchmark_spill():
+    """
+    Run the spill pipeline on synthetic hours of increasing size and check
+    that the peak memory of every process stays below MEMORY_LIMIT_MB while
+    the largest hour needs several times that to be held in memory. With
+    DEDUP set the writers also deduplicate against a persisted index.
+    """
+    file_rows = int(os.getenv("FILE_ROWS", "50000"))
+    scales = [int(scale) for scale in os.getenv("SCALES", "2,4,8,16").split(",")]
+    memory_limit_mb = int(os.getenv("MEMORY_LIMIT_MB", "256"))
+    dedup = os.getenv("DEDUP", "false").lower() == "true"
+
+    print("file_rows:       {}".format(file_rows))
+    print("scales:          {}".format(scales))
+    print("memory_limit_mb: {}".format(memory_limit_mb))
+    print("dedup:           {}".format(dedup))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, "src")
+        os.makedirs(src)
+        paths = create_hour(src, max(scales), file_rows)
+        file_mb = os.path.getsize(paths[0]) / 1024 / 1024
+
+        results = []
+        for scale in scales:
+            dst = os.path.join(tmp, "dst-{}".format(scale))
+            env = dict(os.environ)
+            env.update(
+                {
+                    "BENCHMARK": "spill-run",
+                    "FILES": ",".join(paths[0:scale]),
+                    "DST": dst,
+                }
+            )
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__)],
+                env=env,
+                check=True,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ).stdout.split()
+            results.append([scale] + [int(float(v)) for v in output[-4:]])
+            shutil.rmtree(dst)
+
+        # Measured after the runs, since the peak memory of this process
+        # would otherwise be carried over into each run
+        file_items_mb = items_mb(paths[0])
+    finally:
+        shutil.rmtree(tmp)
+
+    exceeded = False
+    for scale, rows, files, own, children in results:
+        print(
+            "spill {}x: {} rows, {:.0f} MB of logs, {:.0f} MB in memory, "
+            "{} files, peak rss {} MB main, {} MB workers".format(
+                scale,
+                rows,
+                file_mb * scale,
+                file_items_mb * scale,
+                files,
+                own,
+                children,
+            )
+        )
+        if own > memory_limit_mb or children > memory_limit_mb:
+            exceeded = True
+
+    if exceeded:
+        print("peak rss exceeded {} MB".format(memory_limit_mb))
+        sys.exit(1)
+
+
+def benchmark_transforms():
+    rows = int(os.getenv("ROWS", "200000"))
+    repeat = int(os.getenv("REPEAT", "3"))
+
+    print("rows:   {}".format(rows))
+    print("repeat: {}".format(repeat))
+
+    for name, mixed in [("happy", False), ("mixed", True)]:
+        items = [match_log(line) for line in create_lines(rows, mixed)]
+        rate = benchmark_transform(items, repeat)
+        print("transform {}: {:.0f} rows/s".format(name, rate))
+
+
+def main():
+    benchmark = os.getenv("BENCHMARK", "transform")
+    if benchmark == "transform":
+        benchmark_transforms()
+    elif benchmark == "spill":
+        benchmark_spill()
+    elif benchmark == "spill-run":
+        run_spill()
+    else:
+        raise Exception("invalid benchmark " + benchmark)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ from multiprocessing import get_context
 import os
 from pathlib import Path
 import queue
+import shutil
 import sys
 import traceback
 from urllib.parse import urlparse
@@ -18,16 +19,69 @@ import pyarrow as pa
 import pytz
 import s3fs
 
-from s3access.normalize import deserialize_file
-from s3access.parquet import write_dataset
-from s3access.schema import create_schema
+from s3access.dedup import Deduplicator, KeyIndex
+from s3access.normalize import FILTER_FIELDS, create_filters, deserialize_file
+from s3access.parquet import write_dataset, write_quarantine
+from s3access.partition import (
+    OPERATION_GROUP,
+    escape_partition_value,
+    group_rare_operations,
+    parse_partition_cols,
+    partition_schema,
+    summarize_layout,
+)
+from s3access.spill import (
+    DEFAULT_BATCH_ROWS,
+    dedup_spilled_dataset,
+    save_spilled_keys,
+    spill_dataset,
+    write_spilled,
+    write_spilled_dataset,
+)
+from s3access.schema import create_quarantine_schema, create_schema, project_schema
 from s3access.wg import WaitGroup
 
+ROW_GROUP_COLS = ["requester", "remoteip_int", "is_assumed_role", "is_user"]
+
 
 def parse_time(object_name):
     return datetime.strptime(object_name[0:19], "%Y-%m-%d-%H-%M-%S")
 
 
+def parse_list(value):
+    """
+    Return the values in a comma separated list, or None if there are none.
+    """
+    if value is None:
+        return None
+    values = [v.strip() for v in value.split(",") if len(v.strip()) > 0]
+    if len(values) == 0:
+        return None
+    return values
+
+
+def partition_filename(keys, run_id=None):
+    """
+    Return the file name for a partition. When a run_id is given it is added
+    so that the files from earlier runs of the same hour are not overwritten.
+    """
+    name = "-".join([escape_partition_value(y) for y in keys])
+    if run_id is not None:
+        name = "{}-{}".format(name, run_id)
+    return name + ".parquet"
+
+
+def run_id_for(deduplicator):
+    """
+    Return a unique id for this run if the deduplication index is persisted.
+    Re-runs then only write the records not already written, so they must add
+    new files rather than replace the files holding the earlier records.
+    """
+    if deduplicator is not None and deduplicator.index is not None:
+        return uuid.uuid4().hex
+    return None
+
+
 def create_files_index(src, hour, timezone, fs):
     """
     :param str src: The filesystem, s3 or local
@@ -76,6 +130,74 @@ def create_file_system(root, endpoint_url, endpoint_region, s3_acl, logger):
     return None
 
 
+def quarantine_lines(quarantined, quarantine_dst, hour, quarantine_file_system, logger):
+    quarantine_file = "{}{}.parquet".format(quarantine_dst, hour)
+    logger.info(
+        "Quarantining {} malformed lines to {}".format(
+            len(quarantined), quarantine_file
+        )
+    )
+    write_quarantine(
+        quarantined,
+        quarantine_file,
+        create_quarantine_schema(),
+        "SNAPPY",
+        quarantine_file_system,
+        makedirs=(not quarantine_dst.startswith("s3://")),
+    )
+
+
+def quarantine_spilled_lines(
+    quarantined, quarantine_dst, hour, quarantine_file_system, logging_queue, logger
+):
+    quarantine_file = "{}{}.parquet".format(quarantine_dst, hour)
+    logger.info(
+        "Quarantining {} malformed lines to {}".format(
+            sum([q["rows"] for q in quarantined]), quarantine_file
+        )
+    )
+    if not quarantine_dst.startswith("s3://"):
+        os.makedirs(os.path.dirname(quarantine_file), exist_ok=True)
+    rows = write_spilled(
+        [q["path"] for q in quarantined],
+        quarantine_file,
+        create_quarantine_schema(),
+        "SNAPPY",
+        quarantine_file_system,
+        logging_queue,
+    )
+    if rows is None:
+        raise Exception("unable to write quarantine file " + quarantine_file)
+
+
+def complete_range(
+    layout, deduplicator, tracking_file_system, tracking_dst, hour, logger
+):
+    summary = summarize_layout(layout)
+    logger.info("Layout summary:")
+    for k in ["partitions", "files", "rows", "min_rows", "median_rows", "max_rows"]:
+        if k in summary:
+            logger.info("  {}: {}".format(k, summary[k]))
+    for f in sorted(layout, key=lambda f: f["rows"], reverse=True)[0:5]:
+        logger.info("  {} rows: {}".format(f["rows"], f["path"]))
+
+    if deduplicator is not None:
+        logger.info("Saving deduplication index")
+        deduplicator.save()
+
+    if tracking_file_system is not None:
+        logger.info("Tracking completion of task")
+        tracking_file = "{}{}".format(tracking_dst, hour)
+        tracking_file_system.touch(tracking_file)
+        with s3fs.S3File(tracking_file_system, tracking_file, mode="wb") as f:
+            f.write(
+                bytearray(
+                    "Completed hour {}. Now: {}\n".format(hour, datetime.now()), "utf-8"
+                )
+            )
+        logger.info("Successful creation file: {}!".format(tracking_file))
+
+
 def aggregate_range(
     ctx,
     src,
@@ -92,9 +214,25 @@ def aggregate_range(
     cpu_count,
     timeout,
     logging_queue,
+    deduplicator=None,
+    quarantine_dst=None,
+    quarantine_file_system=None,
+    partition_cols=None,
+    rare_operation_threshold=0,
+    max_rows_per_file=None,
+    filters=None,
+    columns=None,
+    row_group_cols=None,
 ):
 
+    if partition_cols is None:
+        partition_cols = parse_partition_cols(None)
+
+    if row_group_cols is None:
+        row_group_cols = ROW_GROUP_COLS
+
     items = []
+    quarantined = []
 
     logger.info("Deserializing data in files from {}".format(src))
 
@@ -103,7 +241,8 @@ def aggregate_range(
         wg = WaitGroup()
 
         def deserialize_file_callback(outputs):
-            items.extend(outputs)
+            items.extend(outputs[0])
+            quarantined.extend(outputs[1])
             wg.done()
 
         def deserialize_file_error_callback(err):
@@ -114,7 +253,7 @@ def aggregate_range(
             wg.add(1)
             pool.apply_async(
                 deserialize_file,
-                args=(f.path, input_file_system, logging_queue),
+                args=(f.path, input_file_system, logging_queue, filters, columns),
                 callback=deserialize_file_callback,
                 error_callback=deserialize_file_error_callback,
             )
@@ -125,47 +264,208 @@ def aggregate_range(
 
     logger.info("Deserialization data in files complete")
 
+    if len(quarantined) > 0 and quarantine_dst is not None:
+        quarantine_lines(
+            quarantined, quarantine_dst, hour, quarantine_file_system, logger
+        )
+        quarantined = []
+
     if len(items) == 0:
         logger.info("No items found in filesystem")
         return
 
+    if deduplicator is not None:
+        logger.info("Deduplicating {} items".format(len(items)))
+        items = deduplicator.filter(items)
+        logger.info(
+            "Dropped {} duplicate items, {} remaining".format(
+                deduplicator.dropped, len(items)
+            )
+        )
+        if len(items) == 0:
+            logger.info("No new items found after deduplication")
+            complete_range(
+                [], deduplicator, tracking_file_system, tracking_dst, hour, logger
+            )
+            return
+
     gc.collect()
 
     df = pd.DataFrame(items)
 
+    if OPERATION_GROUP in partition_cols:
+        df = group_rare_operations(df, partition_cols, rare_operation_threshold)
+
     logger.info("Serializing {} items to {}".format(len(items), dst))
 
     # Drop the memory footprint and garbage collect
     items = []
     gc.collect()
 
-    write_dataset(
+    run_id = run_id_for(deduplicator)
+    failed = []
+
+    layout = write_dataset(
         pa.Table.from_pandas(df, schema=schema, preserve_index=False),
         dst,
         compression="SNAPPY",
-        partition_cols=["bucket_name", "operation", "year", "month", "day", "hour"],
-        partition_filename_cb=lambda x: "-".join([str(y) for y in x]) + ".parquet",
-        row_group_cols=["requester", "remoteip_int", "is_assumed_role", "is_user"],
+        partition_cols=partition_cols,
+        partition_filename_cb=lambda x: partition_filename(x, run_id),
+        row_group_cols=row_group_cols,
         fs=output_file_system,
         cpu_count=cpu_count,
         makedirs=(not dst.startswith("s3://")),
         timeout=timeout,
         logging_queue=logging_queue,
+        max_rows_per_file=max_rows_per_file,
+        failed_collector=failed,
     )
 
     logger.info("Serializing items to {} is complete".format(dst))
 
-    if tracking_file_system is not None:
-        logger.info("Tracking completion of task")
-        tracking_file = "{}{}".format(tracking_dst, hour)
-        tracking_file_system.touch(tracking_file)
-        with s3fs.S3File(tracking_file_system, tracking_file, mode="wb") as f:
-            f.write(
-                bytearray(
-                    "Completed hour {}. Now: {}\n".format(hour, datetime.now()), "utf-8"
+    if deduplicator is not None and len(failed) > 0:
+        positions = [position for index in failed for position in index]
+        logger.error(
+            "{} items could not be written, not saving their keys".format(
+                len(positions)
+            )
+        )
+        deduplicator.discard(df.iloc[positions].to_dict("records"))
+
+    complete_range(
+        layout, deduplicator, tracking_file_system, tracking_dst, hour, logger
+    )
+
+
+def aggregate_range_spill(
+    src,
+    dst,
+    files,
+    logger,
+    schema,
+    input_file_system,
+    output_file_system,
+    tracking_file_system,
+    tracking_dst,
+    hour,
+    cpu_count,
+    timeout,
+    logging_queue,
+    spill_dir,
+    spill_batch_rows=DEFAULT_BATCH_ROWS,
+    deduplicator=None,
+    quarantine_dst=None,
+    quarantine_file_system=None,
+    partition_cols=None,
+    rare_operation_threshold=0,
+    max_rows_per_file=None,
+    filters=None,
+    columns=None,
+):
+    """
+    Like aggregate_range, but the records are spilled to local Arrow IPC files
+    by partition key and each file is then written with bounded memory, so the
+    hour does not need to fit in memory. When deduplicating, the records are
+    first spilled by key bucket and deduplicated one bucket at a time.
+    """
+
+    if partition_cols is None:
+        partition_cols = parse_partition_cols(None)
+
+    spill_root = os.path.join(spill_dir, "{}-{}".format(hour, uuid.uuid4()))
+
+    try:
+        logger.info("Spilling data in files from {} to {}".format(src, spill_root))
+
+        spilled, quarantined = spill_dataset(
+            [f.path for f in files.itertuples()],
+            input_file_system,
+            spill_root,
+            schema,
+            partition_cols,
+            cpu_count=cpu_count,
+            timeout=timeout,
+            logging_queue=logging_queue,
+            batch_rows=spill_batch_rows,
+            filters=filters,
+            columns=columns,
+            dedup=(deduplicator is not None),
+        )
+
+        logger.info("Spilling data in files complete")
+
+        if len(quarantined) > 0 and quarantine_dst is not None:
+            quarantine_spilled_lines(
+                quarantined,
+                quarantine_dst,
+                hour,
+                quarantine_file_system,
+                logging_queue,
+                logger,
+            )
+
+        rows = sum([s["rows"] for s in spilled.values()])
+        if rows == 0:
+            logger.info("No items found in filesystem")
+            return
+
+        if deduplicator is not None:
+            logger.info("Deduplicating {} spilled items".format(rows))
+            spilled, pending, partitions = dedup_spilled_dataset(
+                spilled,
+                spill_root,
+                schema,
+                partition_cols,
+                deduplicator,
+                cpu_count=cpu_count,
+                timeout=timeout,
+                logging_queue=logging_queue,
+            )
+            rows = sum([s["rows"] for s in spilled.values()])
+            logger.info(
+                "Dropped {} duplicate items, {} remaining".format(
+                    deduplicator.dropped, rows
                 )
             )
-        logger.info("Successful creation file: {}!".format(tracking_file))
+
+        logger.info("Serializing {} spilled items to {}".format(rows, dst))
+
+        run_id = run_id_for(deduplicator)
+        failed = []
+
+        layout = write_spilled_dataset(
+            spilled,
+            dst,
+            partition_cols,
+            schema,
+            partition_filename_cb=lambda x: partition_filename(x, run_id),
+            compression="SNAPPY",
+            fs=output_file_system,
+            cpu_count=cpu_count,
+            makedirs=(not dst.startswith("s3://")),
+            timeout=timeout,
+            logging_queue=logging_queue,
+            max_rows_per_file=max_rows_per_file,
+            rare_operation_threshold=rare_operation_threshold,
+            failed_collector=failed,
+        )
+
+        logger.info("Serializing items to {} is complete".format(dst))
+
+        if deduplicator is not None and pending is not None:
+            if len(failed) > 0:
+                logger.error(
+                    "{} spill files could not be written, not saving their keys".format(
+                        len(failed)
+                    )
+                )
+            save_spilled_keys(deduplicator.index, pending, partitions, failed)
+    finally:
+        shutil.rmtree(spill_root, ignore_errors=True)
+
+    complete_range(
+        layout, deduplicator, tracking_file_system, tracking_dst, hour, logger
+    )
 
 
 def configure_logging():
@@ -234,6 +534,9 @@ def main():
     src = os.getenv("SRC")
     dst = os.getenv("DST")
     tracking_dst = os.getenv("TRACKING_DST")
+    quarantine_dst = os.getenv("QUARANTINE_DST")
+    dedup = os.getenv("DEDUP", "false").lower() == "true"
+    dedup_dst = os.getenv("DEDUP_DST")
 
     # Default is to look at the previous hour with the assumption that all the logs exist from that period
     # Importantly this makes it easier to trigger on a cron job and know that the appropriate files are being found
@@ -258,13 +561,42 @@ def main():
 
     timeout = int(os.getenv("TIMEOUT", "300"))
 
+    partition_cols = parse_partition_cols(os.getenv("PARTITION_COLS"))
+    rare_operation_threshold = int(os.getenv("RARE_OPERATION_THRESHOLD", "0"))
+    max_rows_per_file = int(os.getenv("MAX_ROWS_PER_FILE", "0"))
+
+    spill_dir = os.getenv("SPILL_DIR")
+    spill_batch_rows = int(os.getenv("SPILL_BATCH_ROWS", str(DEFAULT_BATCH_ROWS)))
+
+    columns = parse_list(os.getenv("COLUMNS"))
+    include = {}
+    exclude = {}
+    for name in FILTER_FIELDS:
+        include[name] = parse_list(os.getenv("INCLUDE_{}".format(name.upper())))
+        exclude[name] = parse_list(os.getenv("EXCLUDE_{}".format(name.upper())))
+    filters = create_filters(include=include, exclude=exclude)
+
     logger.info("now:          {}".format(now))
     logger.info("cpu_count:    {}".format(cpu_count))
     logger.info("src:          {}".format(src))
     logger.info("dst:          {}".format(dst))
     logger.info("tracking_dst: {}".format(tracking_dst))
+    logger.info("quarantine_dst: {}".format(quarantine_dst))
+    logger.info("dedup:        {}".format(dedup))
+    logger.info("dedup_dst:    {}".format(dedup_dst))
     logger.info("hour:         {}".format(hour))
     logger.info("timeout:      {}".format(timeout))
+    logger.info("partition_cols:           {}".format(partition_cols))
+    logger.info("rare_operation_threshold: {}".format(rare_operation_threshold))
+    logger.info("max_rows_per_file:        {}".format(max_rows_per_file))
+    logger.info("spill_dir:                {}".format(spill_dir))
+    logger.info("spill_batch_rows:         {}".format(spill_batch_rows))
+    logger.info("columns:                  {}".format(columns))
+    for name in FILTER_FIELDS:
+        if include[name] is not None:
+            logger.info("include {}: {}".format(name, include[name]))
+        if exclude[name] is not None:
+            logger.info("exclude {}: {}".format(name, exclude[name]))
     logger.info("aws-region:   {}".format(s3_default_region))
     logger.info("input_s3_acl:       {}".format(input_s3_acl))
     logger.info("input_s3_region:    {}".format(input_s3_region))
@@ -291,6 +623,17 @@ def main():
         if len(tracking_dst) > 0 and tracking_dst[len(tracking_dst) - 1] != "/":
             tracking_dst = tracking_dst + "/"
 
+    # Quarantined lines default to a folder under the destination whose name starts
+    # with an underscore, so that Athena and Glue skip it when reading the dataset.
+    if quarantine_dst is None or len(quarantine_dst) == 0:
+        quarantine_dst = dst + "_quarantine/"
+    elif quarantine_dst[len(quarantine_dst) - 1] != "/":
+        quarantine_dst = quarantine_dst + "/"
+
+    if dedup_dst is not None:
+        if len(dedup_dst) > 0 and dedup_dst[len(dedup_dst) - 1] != "/":
+            dedup_dst = dedup_dst + "/"
+
     #
     # Initialize File Systems
     #
@@ -312,6 +655,34 @@ def main():
                 logger,
             )
 
+    quarantine_file_system = create_file_system(
+        quarantine_dst,
+        output_s3_endpoint,
+        output_s3_region,
+        output_s3_acl,
+        logger,
+    )
+
+    #
+    # Initialize Deduplication
+    #
+
+    deduplicator = None
+    if dedup:
+        index = None
+        if dedup_dst is not None and len(dedup_dst) > 0:
+            index = KeyIndex(
+                dedup_dst,
+                create_file_system(
+                    dedup_dst,
+                    output_s3_endpoint,
+                    output_s3_region,
+                    output_s3_acl,
+                    logger,
+                ),
+            )
+        deduplicator = Deduplicator(index=index)
+
     #
     # Check if this task has been completed already
     #
@@ -327,7 +698,29 @@ def main():
     # Load Schema
     #
 
-    schema = create_schema()
+    schema = partition_schema(create_schema(), partition_cols)
+
+    for col in partition_cols:
+        if col not in schema.names:
+            logger.error("partition column {} is not in the schema".format(col))
+            graceful_shutdown(listener, logging_queue, 1)
+
+    row_group_cols = ROW_GROUP_COLS
+    if columns is not None:
+        for col in columns:
+            if col not in schema.names:
+                logger.error("column {} is not in the schema".format(col))
+                graceful_shutdown(listener, logging_queue, 1)
+        # Only group rows by the projected columns, so the others are not derived
+        row_group_cols = [col for col in ROW_GROUP_COLS if col in columns]
+        # Always keep the columns needed to partition and deduplicate
+        columns = set(columns) | set(partition_cols)
+        if OPERATION_GROUP in partition_cols:
+            columns.add("operation")
+        if dedup:
+            columns |= set(deduplicator.columns)
+        schema = project_schema(schema, columns)
+        logger.info("Projected columns: {}".format(schema.names))
 
     all_files = create_files_index(
         src,
@@ -376,23 +769,59 @@ def main():
         logger.info("Write test success for file {}!".format(write_test))
 
     # The bulk of the work happens here
-    aggregate_range(
-        ctx,
-        src,
-        dst,
-        all_files,
-        utc,
-        logger,
-        schema,
-        input_file_system,
-        output_file_system,
-        tracking_file_system,
-        tracking_dst,
-        hour,
-        cpu_count,
-        timeout,
-        logging_queue,
-    )
+    if spill_dir is not None and len(spill_dir) > 0:
+        aggregate_range_spill(
+            src,
+            dst,
+            all_files,
+            logger,
+            schema,
+            input_file_system,
+            output_file_system,
+            tracking_file_system,
+            tracking_dst,
+            hour,
+            cpu_count,
+            timeout,
+            logging_queue,
+            spill_dir,
+            spill_batch_rows=spill_batch_rows,
+            deduplicator=deduplicator,
+            quarantine_dst=quarantine_dst,
+            quarantine_file_system=quarantine_file_system,
+            partition_cols=partition_cols,
+            rare_operation_threshold=rare_operation_threshold,
+            max_rows_per_file=max_rows_per_file,
+            filters=filters,
+            columns=columns,
+        )
+    else:
+        aggregate_range(
+            ctx,
+            src,
+            dst,
+            all_files,
+            utc,
+            logger,
+            schema,
+            input_file_system,
+            output_file_system,
+            tracking_file_system,
+            tracking_dst,
+            hour,
+            cpu_count,
+            timeout,
+            logging_queue,
+            deduplicator=deduplicator,
+            quarantine_dst=quarantine_dst,
+            quarantine_file_system=quarantine_file_system,
+            partition_cols=partition_cols,
+            rare_operation_threshold=rare_operation_threshold,
+            max_rows_per_file=max_rows_per_file,
+            filters=filters,
+            columns=columns,
+            row_group_cols=row_group_cols,
+        )
 
     graceful_shutdown(listener, logging_queue, 0)
 
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from hashlib import blake2b
+import os
+
+# Each key is stored as a fixed-size digest so the in-memory sets and the
+# persisted index files stay small regardless of the length of the ids.
+KEY_SIZE = 16
+
+# Each hour of the index is split into this many files by key, so that the
+# keys can be checked one bucket at a time. Changing it changes the index
+# layout, so existing indexes would no longer be found.
+KEY_BUCKETS = 16
+
+HOUR_COLS = ["year", "month", "day", "hour"]
+
+
+def record_key(requestid, hostid):
+    """
+    Return the digest identifying a single log record.
+    """
+    return blake2b(
+        "{}\0{}".format(requestid, hostid).encode("utf-8"), digest_size=KEY_SIZE
+    ).digest()
+
+
+def key_bucket(key):
+    """
+    Return the bucket of a record key.
+    """
+    return key[0] % KEY_BUCKETS
+
+
+def partition_name(year, month, day, hour):
+    """
+    Return the index partition name in the same format as the HOUR setting.
+    """
+    return "{:04d}-{:02d}-{:02d}-{:02d}".format(year, month, day, hour)
+
+
+class KeyIndex(object):
+    """KeyIndex persists the keys already written, one file per hour and bucket.
+
+    Each file is the sorted concatenation of the fixed-size record keys.
+    """
+
+    def __init__(self, root, fs=None):
+        self.root = root
+        self.fs = fs
+
+    def path(self, partition):
+        return "{}{}.keys".format(self.root, partition)
+
+    def load(self, partition):
+        path = self.path(partition)
+        if self.fs is not None:
+            if not self.fs.exists(path):
+                return set()
+            with self.fs.open(path, "rb") as f:
+                data = f.read()
+        else:
+            if not os.path.exists(path):
+                return set()
+            with open(path, "rb") as f:
+                data = f.read()
+        starts = range(0, len(data), KEY_SIZE)
+        ends = range(KEY_SIZE, len(data) + KEY_SIZE, KEY_SIZE)
+        return {data[start:end] for start, end in zip(starts, ends)}
+
+    def save(self, partition, keys):
+        path = self.path(partition)
+        data = b"".join(sorted(keys))
+        if self.fs is not None:
+            with self.fs.open(path, "wb") as f:
+                f.write(data)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+
+
+class Deduplicator(object):
+    """Deduplicator drops records whose requestid and hostid were already seen.
+
+    Keys are held in one set per hour and key bucket, so the keys of one
+    bucket can be checked without the others. When an index is given the
+    sets are seeded from, and saved back to, it.
+    """
+
+    def __init__(self, index=None):
+        self.index = index
+        self.columns = ["requestid", "hostid"] + HOUR_COLS
+        self.partitions = {}
+        self.added = {}
+        self.dropped = 0
+
+    def partition(self, row, key):
+        """
+        Return the index partition for a row of values ordered as columns.
+        """
+        return "{}/{:02d}".format(
+            partition_name(row[2], row[3], row[4], row[5]), key_bucket(key)
+        )
+
+    def keys(self, partition):
+        keys = self.partitions.get(partition)
+        if keys is None:
+            keys = self.index.load(partition) if self.index is not None else set()
+            self.partitions[partition] = keys
+        return keys
+
+    def add(self, row):
+        """
+        Return True if the row is new to its partition, False if a duplicate.
+        """
+        key = record_key(row[0], row[1])
+        partition = self.partition(row, key)
+        keys = self.keys(partition)
+        if key in keys:
+            self.dropped += 1
+            return False
+        keys.add(key)
+        self.added.setdefault(partition, set()).add(key)
+        return True
+
+    def discard(self, items):
+        """
+        Forget the keys of items that could not be written, so that they are
+        not saved and a later run writes them again.
+        """
+        for item in items:
+            row = [item[col] for col in self.columns]
+            key = record_key(row[0], row[1])
+            partition = self.partition(row, key)
+            self.keys(partition).discard(key)
+            if partition in self.added:
+                self.added[partition].discard(key)
+
+    def filter(self, items):
+        """
+        Return the items that have not been seen before.
+        """
+        return [item for item in items if self.add([item[col] for col in self.columns])]
+
+    def mask(self, columns):
+        """
+        Return a list of booleans, True for the records not seen before, from
+        a dict of column name to values.
+        """
+        return [self.add(row) for row in zip(*[columns[col] for col in self.columns])]
+
+    def save(self, index=None):
+        """
+        Persist the partitions that gained keys to the index, or to the given
+        index instead. Call after the write succeeds so that a failed run does
+        not mark its records as already written. Return the partitions saved.
+        """
+        if index is None:
+            index = self.index
+        if index is None:
+            return []
+        partitions = sorted(self.added)
+        for partition in partitions:
+            index.save(partition, self.partitions[partition])
+        self.added = {}
+        return partitions
@@ -1,9 +1,52 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
-import ipaddress
-
-from s3access.serializer import deserialize
+from functools import lru_cache
+import socket
+
+from s3access.serializer import iter_log
+
+# https://docs.aws.amazon.com/AmazonS3/latest/userguide/LogFormat.html
+# AWS appends new fields to the end of the record, so older logs have fewer
+# fields and newer logs may have more than this list.
+FIELDS = [
+    "bucketowner",
+    "bucket_name",
+    "requestdatetime",
+    "remoteip",
+    "requester",
+    "requestid",
+    "operation",
+    "key",
+    "request_uri",
+    "httpstatus",
+    "errorcode",
+    "bytessent",
+    "objectsize",
+    "totaltime",
+    "turnaroundtime",
+    "referrer",
+    "useragent",
+    "versionid",
+    "hostid",
+    "sigv",
+    "ciphersuite",
+    "authtype",
+    "endpoint",
+    "tlsversion",
+    "accesspointarn",
+    "aclrequired",
+]
+
+# Records without at least the fields up to versionid are treated as malformed
+MIN_FIELDS = FIELDS.index("versionid") + 1
+
+# Fields that can be filtered on before the record is transformed
+FILTER_FIELDS = ["bucket_name", "requester", "operation", "httpstatus"]
+
+INT_FIELDS = ["bytessent", "objectsize", "totaltime", "turnaroundtime"]
+
+TIME_COLUMNS = ["ts", "year", "month", "day", "hour", "minute", "second", "datetime"]
 
 
 def field_to_int(field):
@@ -15,66 +58,125 @@ def field_to_int(field):
     return int(field)
 
 
-def transform_item(item):
+def create_filters(include=None, exclude=None):
+    """
+    Return the filters for keep_item from dicts of field name to the values to
+    include or exclude. The filters are plain tuples of the field position,
+    the values and whether matching values are kept, so they can be passed to
+    the worker processes.
+    """
+    filters = []
+    for keep, fields in [(True, include), (False, exclude)]:
+        if fields is None:
+            continue
+        for name, values in fields.items():
+            if name not in FILTER_FIELDS:
+                raise ValueError("cannot filter on field {}".format(name))
+            if values is not None and len(values) > 0:
+                filters.append((FIELDS.index(name), frozenset(values), keep))
+    return filters
+
+
+def keep_item(item, filters):
+    """
+    Return True if the raw item passes all of the filters.
+    """
+    for position, values, keep in filters:
+        if (item[position] in values) != keep:
+            return False
+    return True
+
+
+@lru_cache(maxsize=4096)
+def parse_time(requestdatetime):
+    """
+    Return the derived timestamp fields. Records in a log file are close
+    together in time, so the cache avoids most calls to strptime.
+    """
+    ts = datetime.strptime(requestdatetime, "%d/%b/%Y:%H:%M:%S %z")
+    return (
+        ts.timestamp(),
+        ts.year,
+        ts.month,
+        ts.day,
+        ts.hour,
+        ts.minute,
+        ts.second,
+        ts.isoformat(),
+    )
+
+
+def transform_item(item, columns=None):
+    """
+    Return the record as a dict. If columns is given as a set, only those
+    columns are returned and the conversions and derived columns they do not
+    need are skipped.
+    """
 
     #
     # Original record data
     #
-    output = {
-        "bucketowner": item[0],
-        "bucket_name": item[1],
-        "requestdatetime": item[2],
-        "remoteip": item[3],
-        "requester": item[4],
-        "requestid": item[5],
-        "operation": item[6],
-        "key": item[7],
-        "request_uri": item[8],
-        "httpstatus": item[9],
-        "errorcode": item[10],
-        "bytessent": field_to_int(item[11]),
-        "objectsize": field_to_int(item[12]),
-        "totaltime": field_to_int(item[13]),
-        "turnaroundtime": field_to_int(item[14]),
-        "referrer": item[15],
-        "useragent": item[16],
-        "versionid": item[17],
-        "hostid": item[18],
-        "sigv": item[19],
-        "ciphersuite": item[20],
-        "authtype": item[21],
-        "endpoint": item[22],
-        "tlsversion": item[23],
-    }
+
+    fieldcount = len(item)
+    if fieldcount < MIN_FIELDS:
+        raise ValueError(
+            "expected at least {} fields, found {}".format(MIN_FIELDS, fieldcount)
+        )
+
+    output = dict(zip(FIELDS, item))
+    if fieldcount < len(FIELDS):
+        for name in FIELDS[fieldcount:]:
+            output[name] = "-"
+    output["fieldcount"] = fieldcount
+
+    for name in INT_FIELDS:
+        if columns is None or name in columns:
+            output[name] = field_to_int(output[name])
 
     #
     # Timestamp
     #
-    ts = datetime.strptime(output["requestdatetime"], "%d/%b/%Y:%H:%M:%S %z")
-    # convert timestamp from decimal to int
-    output["ts"] = ts.timestamp()
-    # parse timestamp
-    # add the timestamp keys
-    output["year"] = ts.year
-    output["month"] = ts.month
-    output["day"] = ts.day
-    output["hour"] = ts.hour
-    output["minute"] = ts.minute
-    output["second"] = ts.second
-    output["datetime"] = ts.isoformat()
+
+    if columns is None or not columns.isdisjoint(TIME_COLUMNS):
+        (
+            output["ts"],
+            output["year"],
+            output["month"],
+            output["day"],
+            output["hour"],
+            output["minute"],
+            output["second"],
+            output["datetime"],
+        ) = parse_time(output["requestdatetime"])
 
     #
     # IP Address
     #
 
-    output["remoteip_int"] = int(ipaddress.IPv4Address(output["remoteip"]))
+    if columns is None or "remoteip_int" in columns or "remoteip_v6" in columns:
+        remoteip = output["remoteip"]
+        if ":" in remoteip:
+            # remoteip_int stays zero rather than null so rows are not dropped
+            # when it is used as a row group column.
+            output["remoteip_int"] = 0
+            output["remoteip_v6"] = socket.inet_pton(socket.AF_INET6, remoteip)
+        else:
+            output["remoteip_int"] = int.from_bytes(
+                socket.inet_pton(socket.AF_INET, remoteip), "big"
+            )
+            output["remoteip_v6"] = None
 
     #
     # Assumed Role vs User
     #
 
-    output["is_assumed_role"] = "assumed-role" in output["requester"]
-    output["is_user"] = "user" in output["requester"]
+    if columns is None or "is_assumed_role" in columns:
+        output["is_assumed_role"] = "assumed-role" in output["requester"]
+    if columns is None or "is_user" in columns:
+        output["is_user"] = "user" in output["requester"]
+
+    if columns is not None:
+        output = {k: output[k] for k in columns if k in output}
 
     return output
 
@@ -83,7 +185,65 @@ def transform_items(items):
     return [transform_item(item) for item in items]
 
 
-def deserialize_file(f, fs, logging_queue):
-    items = transform_items(deserialize(src=f, format="csv", fs=fs))
+def quarantine_line(f, line, err):
+    """
+    Return the quarantine record for a line. Bytes that are not valid UTF-8
+    are written as escapes so the line can be stored as a string.
+    """
+    line = line.rstrip("\n").encode("utf-8", "surrogateescape")
+    return {
+        "file": f,
+        "line": line.decode("utf-8", "backslashreplace"),
+        "error": str(err),
+    }
+
+
+def iter_items(f, fs, stats, filters=None, columns=None):
+    """
+    Yield the transformed items in the file. Lines that do not pass the
+    filters are counted in stats["filtered"] without being transformed, and
+    lines that are not valid UTF-8 or cannot be transformed are added to
+    stats["quarantined"] so that one malformed line does not fail the whole
+    file.
+    """
+    for line, item in iter_log(f, fs=fs):
+        if len(item) == 0:
+            continue
+        if not line.isascii():
+            try:
+                line.encode("utf-8")
+            except UnicodeEncodeError:
+                stats["quarantined"].append(
+                    quarantine_line(f, line, "line is not valid UTF-8")
+                )
+                continue
+        if filters and len(item) >= MIN_FIELDS and not keep_item(item, filters):
+            stats["filtered"] += 1
+            continue
+        try:
+            output = transform_item(item, columns=columns)
+        except (ValueError, OSError) as err:
+            stats["quarantined"].append(quarantine_line(f, line, err))
+            continue
+        yield output
+
+
+def log_stats(f, stats, logging_queue):
     logging_queue.put("Completed deserializing {}".format(f))
-    return items
+    if stats["filtered"] > 0:
+        logging_queue.put("Filtered {} lines from {}".format(stats["filtered"], f))
+    if len(stats["quarantined"]) > 0:
+        logging_queue.put(
+            "Quarantined {} lines from {}".format(len(stats["quarantined"]), f)
+        )
+
+
+def deserialize_file(f, fs, logging_queue, filters=None, columns=None):
+    """
+    Return the transformed items in the file and the lines that could not be
+    transformed.
+    """
+    stats = {"filtered": 0, "quarantined": []}
+    items = list(iter_items(f, fs, stats, filters=filters, columns=columns))
+    log_stats(f, stats, logging_queue)
+    return items, stats["quarantined"]
@@ -7,23 +7,33 @@ import pyarrow.parquet as pq
 import pyarrow as pa
 from pyarrow.util import guid
 
+from s3access.partition import partition_subdir
 from s3access.wg import WaitGroup
 
 
 def write_partition(df, full_path, cols, schema, compression, fs, logging_queue):
+    """
+    Write the partition to a single parquet file with a row group per
+    distinct value of cols. Return True if the file was written.
+    """
     logging_queue.put("write_partition: {}".format(full_path))
     try:
         writer = pq.ParquetWriter(
             full_path, schema, compression=compression, filesystem=fs
         )
 
-        for keys, rg in df.groupby([df[col] for col in cols]):
-            writer.write_table(pa.Table.from_pandas(rg, schema=schema, safe=False))
+        if cols:
+            for keys, rg in df.groupby([df[col] for col in cols]):
+                writer.write_table(pa.Table.from_pandas(rg, schema=schema, safe=False))
+        else:
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, safe=False))
 
         writer.close()
     except Exception as err:
         logging_queue.put("Unable to write partition {}: {}".format(full_path, err))
         traceback.print_exc()
+        return False
+    return True
 
 
 # write_to_dataset supports writing row groups
@@ -41,7 +51,16 @@ def write_dataset(
     makedirs=False,
     timeout=None,
     logging_queue=None,
+    max_rows_per_file=None,
+    failed_collector=None,
 ):
+    """
+    Write the table as a Hive style partitioned dataset and return the layout
+    as a list of the files written. Partitions with more than
+    max_rows_per_file rows are split into several files written in parallel.
+    If failed_collector is given, the row positions in the table of each file
+    that could not be written are appended to it.
+    """
 
     df = table.to_pandas()
 
@@ -54,44 +73,77 @@ def write_dataset(
     if len(data_cols) == 0:
         raise ValueError("No data left to save outside partition columns")
 
+    # Partition columns are dropped from the data, so they cannot be used to
+    # group rows within a file
+    row_group_cols = [col for col in row_group_cols or [] if col not in partition_cols]
+
     subschema = table.schema
 
     for col in table.schema.names:
         if col in partition_cols:
             subschema = subschema.remove(subschema.get_field_index(col))
 
-    with get_context("spawn").Pool(processes=int(cpu_count)) as pool:
+    # Plan the files first so the largest can be started first and do not
+    # become the straggler at the end of the pool.
+    tasks = []
 
-        wg = WaitGroup()
+    for keys, dfp in data_df.groupby(partition_keys):
 
-        def write_partition_callback(outputs):
-            wg.done()
+        if not isinstance(keys, tuple):
+            keys = (keys,)
 
-        def write_partition_error_callback(err):
-            traceback.print_exc()
-            raise err
+        subdir = partition_subdir(partition_cols, keys)
 
-        for keys, dfp in data_df.groupby(partition_keys):
+        if makedirs:
+            os.makedirs(os.path.join(root_path, subdir), exist_ok=True)
 
-            if not isinstance(keys, tuple):
-                keys = (keys,)
+        if partition_filename_cb:
+            outfile = partition_filename_cb(keys)
+        else:
+            outfile = guid() + ".parquet"
 
-            subdir = "/".join(
-                [
-                    "{colname}={value}".format(colname=name, value=val)
-                    for name, val in zip(partition_cols, keys)
-                ]
-            )
+        if max_rows_per_file and len(dfp) > max_rows_per_file:
+            # Sort so that each file holds whole row groups where possible
+            if row_group_cols:
+                dfp = dfp.sort_values(row_group_cols, kind="stable")
+            base, ext = os.path.splitext(outfile)
+            for i, start in enumerate(range(0, len(dfp), max_rows_per_file)):
+                end = start + max_rows_per_file
+                chunkfile = "{}-{:04d}{}".format(base, i, ext)
+                tasks.append(
+                    (
+                        subdir,
+                        os.path.join(root_path, subdir, chunkfile),
+                        dfp.iloc[start:end],
+                    )
+                )
+        else:
+            tasks.append((subdir, os.path.join(root_path, subdir, outfile), dfp))
+
+    tasks.sort(key=lambda task: len(task[2]), reverse=True)
+
+    layout = []
+
+    with get_context("spawn").Pool(processes=int(cpu_count)) as pool:
+
+        wg = WaitGroup()
 
-            if makedirs:
-                os.makedirs(os.path.join(root_path, subdir), exist_ok=True)
+        def write_partition_error_callback(err):
+            traceback.print_exc()
+            raise err
 
-            if partition_filename_cb:
-                outfile = partition_filename_cb(keys)
-            else:
-                outfile = guid() + ".parquet"
+        for subdir, full_path, dfp in tasks:
 
-            full_path = os.path.join(root_path, subdir, outfile)
+            def write_partition_callback(
+                outputs, subdir=subdir, full_path=full_path, dfp=dfp
+            ):
+                if outputs:
+                    layout.append(
+                        {"partition": subdir, "path": full_path, "rows": len(dfp)}
+                    )
+                elif failed_collector is not None:
+                    failed_collector.append(dfp.index)
+                wg.done()
 
             wg.add(1)
             pool.apply_async(
@@ -110,3 +162,19 @@ def write_dataset(
             )
 
         wg.wait(timeout=timeout)
+
+    return layout
+
+
+def write_quarantine(items, full_path, schema, compression, fs, makedirs=False):
+    """
+    Write the lines that could not be transformed to a single parquet file.
+    """
+    if makedirs:
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+    table = pa.Table.from_pydict(
+        {name: [item[name] for item in items] for name in schema.names},
+        schema=schema,
+    )
+    pq.write_table(table, full_path, compression=compression, filesystem=fs)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from urllib.parse import quote
+
+import pyarrow as pa
+
+DEFAULT_PARTITION_COLS = ["bucket_name", "operation", "year", "month", "day", "hour"]
+
+# operation_group is derived from operation, so it can be used as a partition
+# column while the original operation remains a data column.
+OPERATION_GROUP = "operation_group"
+OTHER_OPERATIONS = "OTHER"
+
+
+def parse_partition_cols(value):
+    """
+    Return the partition columns from a comma separated list.
+    """
+    if value is None or len(value.strip()) == 0:
+        return list(DEFAULT_PARTITION_COLS)
+    return [col.strip() for col in value.split(",") if len(col.strip()) > 0]
+
+
+def escape_partition_value(value):
+    """
+    Return the value percent-encoded, as Hive and pyarrow do, so that values
+    such as requester ARNs containing "/" stay a single path segment.
+    """
+    return quote(str(value), safe="")
+
+
+def partition_subdir(partition_cols, keys):
+    """
+    Return the Hive style directory for the partition keys.
+    """
+    return "/".join(
+        [
+            "{colname}={value}".format(colname=name, value=escape_partition_value(val))
+            for name, val in zip(partition_cols, keys)
+        ]
+    )
+
+
+def partition_schema(schema, partition_cols):
+    """
+    Return the schema with any derived partition columns added.
+    """
+    if OPERATION_GROUP in partition_cols and OPERATION_GROUP not in schema.names:
+        schema = schema.append(pa.field(OPERATION_GROUP, pa.string()))
+    return schema
+
+
+def group_rare_operations(df, partition_cols, threshold):
+    """
+    Add the operation_group column. Operations with fewer than threshold rows
+    within their partition are grouped together as OTHER so they do not each
+    create a tiny file. Pass the records left after filtering and
+    deduplication, which are what the spill path counts too.
+    """
+    if threshold <= 0:
+        df[OPERATION_GROUP] = df["operation"]
+        return df
+
+    keys = [col for col in partition_cols if col != OPERATION_GROUP] + ["operation"]
+    counts = df.groupby(keys)["operation"].transform("size")
+    df[OPERATION_GROUP] = df["operation"].where(counts >= threshold, OTHER_OPERATIONS)
+    return df
+
+
+def summarize_layout(layout):
+    """
+    Return a summary of the files written by write_dataset.
+    """
+    rows = sorted([f["rows"] for f in layout])
+    if len(rows) == 0:
+        return {"partitions": 0, "files": 0, "rows": 0}
+    return {
+        "partitions": len(set([f["partition"] for f in layout])),
+        "files": len(rows),
+        "rows": sum(rows),
+        "min_rows": rows[0],
+        "median_rows": rows[len(rows) // 2],
+        "max_rows": rows[-1],
+    }
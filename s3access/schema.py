@@ -29,7 +29,10 @@ def create_schema():
         pa.field("authtype", pa.string()),
         pa.field("endpoint", pa.string()),
         pa.field("tlsversion", pa.string()),
+        pa.field("accesspointarn", pa.string()),
+        pa.field("aclrequired", pa.string()),
         # New fields derived from data
+        pa.field("fieldcount", pa.int32()),
         pa.field("ts", pa.int64()),
         pa.field("year", pa.int64()),
         pa.field("month", pa.int32()),
@@ -39,7 +42,24 @@ def create_schema():
         pa.field("second", pa.int32()),
         pa.field("datetime", pa.string()),
         pa.field("remoteip_int", pa.uint32()),
+        pa.field("remoteip_v6", pa.binary(16)),
         pa.field("is_assumed_role", pa.bool_()),
         pa.field("is_user", pa.bool_()),
     ]
     return pa.schema(fields)
+
+
+def create_quarantine_schema():
+    fields = [
+        pa.field("file", pa.string()),
+        pa.field("line", pa.string()),
+        pa.field("error", pa.string()),
+    ]
+    return pa.schema(fields)
+
+
+def project_schema(schema, columns):
+    """
+    Return the schema with only the given columns, keeping the schema order.
+    """
+    return pa.schema([field for field in schema if field.name in columns])
@@ -10,18 +10,28 @@ def match_log(line):
     return [a or b or c for a, b, c in result]
 
 
+def iter_log(src, fs=None):
+    """
+    Yield each line of the log file along with its fields. Bytes that are not
+    valid UTF-8 are kept as surrogates so one bad line does not fail the file.
+    """
+    if fs is not None:
+        with fs.open(src, "r", encoding="utf-8", errors="surrogateescape") as f:
+            for line in f:
+                yield line, match_log(line)
+    else:
+        with open(src, "r", encoding="utf-8", errors="surrogateescape") as f:
+            for line in f:
+                yield line, match_log(line)
+
+
 def deserialize(
     src=None,
     format=None,
     fs=None,
 ):
     if format == "csv":
-        if fs is not None:
-            with fs.open(src, "r") as f:
-                return [match_log(line) for line in f]
-        else:
-            with open(src, "r") as f:
-                return [match_log(line) for line in f]
+        return [fields for line, fields in iter_log(src, fs=fs)]
     else:
         raise Exception("invalid format " + format)
     return None
@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+from multiprocessing import get_context
+import os
+import traceback
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow.util import guid
+
+from s3access.dedup import KEY_BUCKETS, Deduplicator, KeyIndex, key_bucket, record_key
+from s3access.normalize import iter_items, log_stats
+from s3access.partition import OPERATION_GROUP, OTHER_OPERATIONS, partition_subdir
+from s3access.schema import create_quarantine_schema
+from s3access.wg import WaitGroup
+
+# Rows buffered per partition key in each worker before spilling a batch
+DEFAULT_BATCH_ROWS = 10000
+
+# Rows buffered by each writer before writing a parquet row group
+DEFAULT_ROW_GROUP_ROWS = 131072
+
+
+def spill_cols(partition_cols):
+    """
+    Return the columns records are spilled by. Rare operations can only be
+    grouped once every file has been spilled, so records are spilled by
+    operation and mapped to their operation_group when written.
+    """
+    return ["operation" if col == OPERATION_GROUP else col for col in partition_cols]
+
+
+def spill_schema(schema):
+    """
+    Return the schema records are spilled with. operation_group is derived
+    when writing, so it is not spilled.
+    """
+    if OPERATION_GROUP in schema.names:
+        schema = schema.remove(schema.get_field_index(OPERATION_GROUP))
+    return schema
+
+
+class SpillFiles(object):
+    """SpillFiles appends tables to one Arrow IPC stream file per key."""
+
+    def __init__(self, spill_root, schema):
+        self.spill_root = spill_root
+        self.schema = schema
+        self.files = {}
+
+    def write(self, key, table):
+        s = self.files.get(key)
+        if s is None:
+            path = os.path.join(self.spill_root, guid() + ".arrow")
+            sink = pa.OSFile(path, "wb")
+            s = {
+                "path": path,
+                "rows": 0,
+                "sink": sink,
+                "writer": pa.ipc.new_stream(sink, self.schema),
+            }
+            self.files[key] = s
+        s["writer"].write_table(table)
+        s["rows"] += table.num_rows
+
+    def close(self):
+        for s in self.files.values():
+            s["writer"].close()
+            s["sink"].close()
+
+    def outputs(self):
+        return [
+            {"key": key, "path": s["path"], "rows": s["rows"]}
+            for key, s in self.files.items()
+        ]
+
+
+def iter_spilled(paths):
+    """
+    Yield the batches in the spill files as tables.
+    """
+    for path in paths:
+        with pa.OSFile(path, "rb") as source:
+            for batch in pa.ipc.open_stream(source):
+                yield pa.Table.from_batches([batch])
+
+
+def spill_file(
+    f,
+    fs,
+    logging_queue,
+    spill_root,
+    schema,
+    key_cols,
+    batch_rows,
+    filters=None,
+    columns=None,
+    dedup=False,
+):
+    """
+    Transform the file and append its records to one Arrow IPC stream file
+    per partition key under spill_root, or per key bucket when deduplicating.
+    At most batch_rows records per key are held in memory. Return the spill
+    files written and the spill file of the lines that could not be
+    transformed, if any.
+    """
+    stats = {"filtered": 0, "quarantined": []}
+    buffers = {}
+    files = SpillFiles(spill_root, schema)
+
+    # Records are spread evenly over the key buckets, so each bucket buffers
+    # its share of batch_rows to keep the same total in memory
+    if dedup:
+        batch_rows = max(1, batch_rows // KEY_BUCKETS)
+
+    def spill(key, items):
+        files.write(
+            key,
+            pa.Table.from_pydict(
+                {name: [item[name] for item in items] for name in schema.names},
+                schema=schema,
+            ),
+        )
+
+    try:
+        for item in iter_items(f, fs, stats, filters=filters, columns=columns):
+            if dedup:
+                key = key_bucket(record_key(item["requestid"], item["hostid"]))
+            else:
+                key = tuple([item[col] for col in key_cols])
+            items = buffers.get(key)
+            if items is None:
+                items = []
+                buffers[key] = items
+            items.append(item)
+            if len(items) >= batch_rows:
+                spill(key, items)
+                buffers[key] = []
+
+        for key, items in buffers.items():
+            if len(items) > 0:
+                spill(key, items)
+    finally:
+        files.close()
+
+    log_stats(f, stats, logging_queue)
+
+    # Quarantined lines are spilled too, so a badly corrupted hour does not
+    # collect every line in the main process
+    quarantined = SpillFiles(spill_root, create_quarantine_schema())
+    if len(stats["quarantined"]) > 0:
+        try:
+            quarantined.write(
+                None,
+                pa.Table.from_pydict(
+                    {
+                        name: [item[name] for item in stats["quarantined"]]
+                        for name in quarantined.schema.names
+                    },
+                    schema=quarantined.schema,
+                ),
+            )
+        finally:
+            quarantined.close()
+
+    return files.outputs(), quarantined.outputs()
+
+
+def spill_dataset(
+    files,
+    fs,
+    spill_root,
+    schema,
+    partition_cols,
+    cpu_count=None,
+    timeout=None,
+    logging_queue=None,
+    batch_rows=DEFAULT_BATCH_ROWS,
+    filters=None,
+    columns=None,
+    dedup=False,
+):
+    """
+    Spill the records in all files by partition key, or by key bucket when
+    deduplicating. Return a dict of the spill key to its spill files and
+    total rows, and the spill files of the lines that could not be
+    transformed.
+    """
+    os.makedirs(spill_root, exist_ok=True)
+
+    schema = spill_schema(schema)
+    key_cols = spill_cols(partition_cols)
+
+    spilled = {}
+    quarantined = []
+
+    with get_context("spawn").Pool(processes=int(cpu_count)) as pool:
+
+        wg = WaitGroup()
+
+        def spill_file_callback(outputs):
+            for s in outputs[0]:
+                if s["key"] not in spilled:
+                    spilled[s["key"]] = {"files": [], "rows": 0}
+                spilled[s["key"]]["files"].append(s)
+                spilled[s["key"]]["rows"] += s["rows"]
+            quarantined.extend(outputs[1])
+            wg.done()
+
+        def spill_file_error_callback(err):
+            traceback.print_exc()
+            raise err
+
+        for f in files:
+            wg.add(1)
+            pool.apply_async(
+                spill_file,
+                args=(
+                    f,
+                    fs,
+                    logging_queue,
+                    spill_root,
+                    schema,
+                    key_cols,
+                    batch_rows,
+                    filters,
+                    columns,
+                    dedup,
+                ),
+                callback=spill_file_callback,
+                error_callback=spill_file_error_callback,
+            )
+
+        wg.wait(timeout=timeout)
+
+    return spilled, quarantined
+
+
+def dedup_spilled(
+    bucket, paths, spill_root, schema, key_cols, index, pending, logging_queue
+):
+    """
+    Drop the duplicate records in the spill files of one key bucket and spill
+    the others by partition key. Only the keys of the bucket are held in
+    memory. The keys are saved to pending rather than to the index, so they
+    are only saved once the records are written. Return the spill files
+    written, the rows dropped and the index partitions saved to pending.
+    """
+    logging_queue.put("dedup_spilled: bucket {}".format(bucket))
+    deduplicator = Deduplicator(index=index)
+    files = SpillFiles(spill_root, schema)
+    try:
+        for table in iter_spilled(paths):
+            mask = deduplicator.mask(
+                {col: table.column(col).to_pylist() for col in deduplicator.columns}
+            )
+            table = table.filter(pa.array(mask, type=pa.bool_()))
+            if len(key_cols) == 0:
+                files.write((), table)
+                continue
+            rows = {}
+            keys = zip(*[table.column(col).to_pylist() for col in key_cols])
+            for i, key in enumerate(keys):
+                rows.setdefault(key, []).append(i)
+            for key, indices in rows.items():
+                files.write(key, table.take(pa.array(indices, type=pa.int64())))
+    finally:
+        files.close()
+
+    for path in paths:
+        os.remove(path)
+
+    partitions = deduplicator.save(pending) if pending is not None else []
+
+    return files.outputs(), deduplicator.dropped, partitions
+
+
+def dedup_spilled_dataset(
+    spilled,
+    spill_root,
+    schema,
+    partition_cols,
+    deduplicator,
+    cpu_count=None,
+    timeout=None,
+    logging_queue=None,
+):
+    """
+    Deduplicate the records spilled by key bucket, one bucket per task, and
+    return them spilled by partition key in the same form as spill_dataset.
+    Also return the index the keys are saved to until the records are written,
+    and its partitions, for save_spilled_keys. The rows dropped are added to
+    the deduplicator.
+    """
+    schema = spill_schema(schema)
+    key_cols = spill_cols(partition_cols)
+
+    pending = None
+    if deduplicator.index is not None:
+        pending = KeyIndex(os.path.join(spill_root, "_keys") + "/")
+
+    deduped = {}
+    partitions = []
+
+    with get_context("spawn").Pool(processes=int(cpu_count)) as pool:
+
+        wg = WaitGroup()
+
+        def dedup_spilled_callback(outputs):
+            for s in outputs[0]:
+                if s["key"] not in deduped:
+                    deduped[s["key"]] = {"files": [], "rows": 0}
+                deduped[s["key"]]["files"].append(s)
+                deduped[s["key"]]["rows"] += s["rows"]
+            deduplicator.dropped += outputs[1]
+            partitions.extend(outputs[2])
+            wg.done()
+
+        def dedup_spilled_error_callback(err):
+            traceback.print_exc()
+            raise err
+
+        for bucket, s in spilled.items():
+            wg.add(1)
+            pool.apply_async(
+                dedup_spilled,
+                args=(
+                    bucket,
+                    [f["path"] for f in s["files"]],
+                    spill_root,
+                    schema,
+                    key_cols,
+                    deduplicator.index,
+                    pending,
+                    logging_queue,
+                ),
+                callback=dedup_spilled_callback,
+                error_callback=dedup_spilled_error_callback,
+            )
+
+        wg.wait(timeout=timeout)
+
+    return deduped, pending, sorted(partitions)
+
+
+def save_spilled_keys(index, pending, partitions, failed):
+    """
+    Save the keys in pending to the index, one partition at a time, leaving
+    out the keys of the records in the failed spill files so that a later run
+    writes them again.
+    """
+    failed_keys = Deduplicator()
+    for table in iter_spilled(failed):
+        failed_keys.mask(
+            {col: table.column(col).to_pylist() for col in failed_keys.columns}
+        )
+    for partition in partitions:
+        keys = pending.load(partition)
+        keys -= failed_keys.added.get(partition, set())
+        index.save(partition, keys)
+
+
+def write_spilled(
+    paths,
+    full_path,
+    schema,
+    compression,
+    fs,
+    logging_queue,
+    row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+):
+    """
+    Write the spill files to a single parquet file, holding at most about
+    row_group_rows rows in memory. Unlike write_partition the row groups are
+    not grouped by column values, since that would need the whole partition
+    in memory. Return the rows written, or None if the file failed.
+    """
+    logging_queue.put("write_spilled: {}".format(full_path))
+    writer = None
+    rows = 0
+    try:
+        tables = []
+        buffered = 0
+        for table in iter_spilled(paths):
+            if table.num_rows == 0:
+                continue
+            tables.append(
+                pa.Table.from_arrays(
+                    [table.column(name) for name in schema.names],
+                    schema=schema,
+                )
+            )
+            buffered += table.num_rows
+            if buffered >= row_group_rows:
+                if writer is None:
+                    writer = pq.ParquetWriter(
+                        full_path,
+                        schema,
+                        compression=compression,
+                        filesystem=fs,
+                    )
+                writer.write_table(pa.concat_tables(tables))
+                rows += buffered
+                tables = []
+                buffered = 0
+
+        if buffered > 0:
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    full_path, schema, compression=compression, filesystem=fs
+                )
+            writer.write_table(pa.concat_tables(tables))
+            rows += buffered
+
+        if writer is not None:
+            writer.close()
+    except Exception as err:
+        logging_queue.put("Unable to write partition {}: {}".format(full_path, err))
+        traceback.print_exc()
+        return None
+
+    return rows
+
+
+def write_spilled_dataset(
+    spilled,
+    root_path,
+    partition_cols,
+    schema,
+    partition_filename_cb=None,
+    compression=None,
+    fs=None,
+    cpu_count=None,
+    makedirs=False,
+    timeout=None,
+    logging_queue=None,
+    max_rows_per_file=None,
+    rare_operation_threshold=0,
+    row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+    failed_collector=None,
+):
+    """
+    Write the spilled records as a Hive style partitioned dataset, each file
+    written independently with bounded memory. Return the layout as a list of
+    the files written, in the same form as write_dataset. The spill files of
+    the files that could not be written are added to failed_collector.
+    """
+    subschema = schema
+    for col in partition_cols:
+        if col in subschema.names:
+            subschema = subschema.remove(subschema.get_field_index(col))
+
+    # Map each spill key to its output partition, grouping rare operations.
+    # The rows are counted after filtering and deduplication, as
+    # group_rare_operations counts them, so both paths write the same layout.
+    partitions = {}
+    for key, s in spilled.items():
+        keys = list(key)
+        if OPERATION_GROUP in partition_cols and s["rows"] < rare_operation_threshold:
+            keys[partition_cols.index(OPERATION_GROUP)] = OTHER_OPERATIONS
+        keys = tuple(keys)
+        if keys not in partitions:
+            partitions[keys] = []
+        partitions[keys].append(s)
+
+    tasks = []
+
+    for keys, spills in partitions.items():
+
+        subdir = partition_subdir(partition_cols, keys)
+
+        if makedirs:
+            os.makedirs(os.path.join(root_path, subdir), exist_ok=True)
+
+        if partition_filename_cb:
+            outfile = partition_filename_cb(keys)
+        else:
+            outfile = guid() + ".parquet"
+
+        # Split by spill file so each output file is written from whole files
+        chunks = [[]]
+        chunk_rows = [0]
+        for spill in spills:
+            for f in spill["files"]:
+                if (
+                    max_rows_per_file
+                    and chunk_rows[-1] > 0
+                    and chunk_rows[-1] + f["rows"] > max_rows_per_file
+                ):
+                    chunks.append([])
+                    chunk_rows.append(0)
+                chunks[-1].append(f["path"])
+                chunk_rows[-1] += f["rows"]
+
+        if len(chunks) == 1:
+            tasks.append(
+                (
+                    subdir,
+                    os.path.join(root_path, subdir, outfile),
+                    chunks[0],
+                    chunk_rows[0],
+                )
+            )
+        else:
+            base, ext = os.path.splitext(outfile)
+            for i, paths in enumerate(chunks):
+                chunkfile = "{}-{:04d}{}".format(base, i, ext)
+                tasks.append(
+                    (
+                        subdir,
+                        os.path.join(root_path, subdir, chunkfile),
+                        paths,
+                        chunk_rows[i],
+                    )
+                )
+
+    tasks.sort(key=lambda task: task[3], reverse=True)
+
+    layout = []
+
+    with get_context("spawn").Pool(processes=int(cpu_count)) as pool:
+
+        wg = WaitGroup()
+
+        def write_spilled_error_callback(err):
+            traceback.print_exc()
+            raise err
+
+        for subdir, full_path, paths, rows in tasks:
+
+            def write_spilled_callback(
+                rows, subdir=subdir, full_path=full_path, paths=paths
+            ):
+                if rows is None:
+                    if failed_collector is not None:
+                        failed_collector.extend(paths)
+                elif rows > 0:
+                    layout.append(
+                        {
+                            "partition": subdir,
+                            "path": full_path,
+                            "rows": rows,
+                        }
+                    )
+                wg.done()
+
+            wg.add(1)
+            pool.apply_async(
+                write_spilled,
+                args=(
+                    paths,
+                    full_path,
+                    subschema,
+                    compression,
+                    fs,
+                    logging_queue,
+                    row_group_rows,
+                ),
+                callback=write_spilled_callback,
+                error_callback=write_spilled_error_callback,
+            )
+
+        wg.wait(timeout=timeout)
+
+    return layout